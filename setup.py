@@ -17,7 +17,8 @@ setup(
   ],
   install_requires=[
     'einops>=0.3',
-    'torch>=1.6',
+    'numpy',
+    'torch>=2.2',
     'torchvision',
     'pytesseract',
     'transformers',
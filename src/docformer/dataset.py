@@ -260,6 +260,9 @@ def create_features(
         })
     assert torch.lt(encoding["x_features"], 0).sum().item() == 0
     assert torch.lt(encoding["y_features"], 0).sum().item() == 0
+    # the model's 2D position tables have max_2d_position_embeddings (>= GRID_SIZE) rows per feature
+    assert torch.ge(encoding["x_features"], GRID_SIZE).sum().item() == 0
+    assert torch.ge(encoding["y_features"], GRID_SIZE).sum().item() == 0
 
     # step 13: add tokens for debugging
     if extras_for_debugging:
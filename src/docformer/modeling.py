@@ -1,15 +1,13 @@
+import contextlib
 import math
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
-from einops import rearrange
 from torch import Tensor
 
 
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-
-
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 5000):
         super().__init__()
@@ -23,9 +21,9 @@ class PositionalEncoding(nn.Module):
         pe[0, :, 1::2] = torch.cos(position * div_term)
         self.register_buffer("pe", pe)
 
-    def forward(self) -> Tensor:
-        x = self.pe[0, : self.max_len]
-        return self.dropout(x).unsqueeze(0)
+    def forward(self, x: Tensor) -> Tensor:
+        x = x + self.pe
+        return self.dropout(x) if self.training else x
 
 
 class ResNetFeatureExtractor(nn.Module):
@@ -37,21 +35,23 @@ class ResNetFeatureExtractor(nn.Module):
 
         resnet50 = models.resnet50(pretrained=False)
         modules = list(resnet50.children())[:-2]
-        self.resnet50 = nn.Sequential(*modules)
+        # channels_last (NHWC) lets cuDNN pick the tensor core friendly conv kernels
+        self.resnet50 = nn.Sequential(*modules).to(memory_format=torch.channels_last)
 
         # Applying convolution and linear layer
 
-        self.conv1 = nn.Conv2d(2048, 768, 1)
-        self.relu1 = F.relu
+        self.conv1 = nn.Conv2d(2048, 768, 1).to(memory_format=torch.channels_last)
+        self.relu1 = F.relu_
         self.linear1 = nn.Linear(49, 512)
 
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.resnet50(x)
         x = self.conv1(x)
         x = self.relu1(x)
-        x = rearrange(x, "b e w h -> b e (w h)")  # b -> batch, e -> embedding dim, w -> width, h -> height
+        x = x.flatten(2)  # (batch, embedding dim, width, height) -> (batch, embedding dim, width * height)
         x = self.linear1(x)
-        x = rearrange(x, "b e s -> b s e")  # b -> batch, e -> embedding dim, s -> sequence length
+        x = x.transpose(1, 2)  # (batch, embedding dim, sequence length) -> (batch, sequence length, embedding dim)
         return x
 
 
@@ -74,24 +74,17 @@ class DocFormerEmbeddings(nn.Module):
             max_len=config["max_position_embeddings"],
         )
 
-        self.x_v = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.x_topleft_position_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.x_bottomright_position_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.w_position_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_topleft_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_bottomleft_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_topright_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_bottomright_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_centroid_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-
-        self.y_topleft_position_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.y_bottomright_position_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.h_position_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_topleft_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_bottomleft_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_topright_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_bottomright_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_centroid_distance_to_prev_embeddings_v = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
+        # Each of the 8 box features (see `forward`) gets its own block of
+        # `max_2d_position_embeddings` rows in a shared table, so that the features are
+        # embedded with one lookup per table instead of one per feature. Features 0-1
+        # (top left / bottom right) use `coordinate_size` dims, features 2-7 `shape_size`.
+        # Sparse gradients (`sparse_2d_embeddings`) need an optimizer like SparseAdam.
+        max_2d_positions = self.max_2d_positions = config["max_2d_position_embeddings"]
+        sparse = config.get("sparse_2d_embeddings", False)
+        self.x_position_embeddings_v = nn.Embedding(2 * max_2d_positions, config["coordinate_size"], sparse=sparse)
+        self.x_shape_embeddings_v = nn.Embedding(6 * max_2d_positions, config["shape_size"], sparse=sparse)
+        self.y_position_embeddings_v = nn.Embedding(2 * max_2d_positions, config["coordinate_size"], sparse=sparse)
+        self.y_shape_embeddings_v = nn.Embedding(6 * max_2d_positions, config["shape_size"], sparse=sparse)
 
         self.position_embeddings_t = PositionalEncoding(
             d_model=config["hidden_size"],
@@ -99,70 +92,42 @@ class DocFormerEmbeddings(nn.Module):
             max_len=config["max_position_embeddings"],
         )
 
-        self.x_topleft_position_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.x_bottomright_position_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.w_position_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_topleft_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_bottomleft_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_topright_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_bottomright_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.x_centroid_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-
-        self.y_topleft_position_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.y_bottomright_position_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["coordinate_size"])
-        self.h_position_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_topleft_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_bottomleft_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_topright_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_bottomright_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
-        self.y_centroid_distance_to_prev_embeddings_t = nn.Embedding(config["max_2d_position_embeddings"], config["shape_size"])
+        self.x_position_embeddings_t = nn.Embedding(2 * max_2d_positions, config["coordinate_size"], sparse=sparse)
+        self.x_shape_embeddings_t = nn.Embedding(6 * max_2d_positions, config["shape_size"], sparse=sparse)
+        self.y_position_embeddings_t = nn.Embedding(2 * max_2d_positions, config["coordinate_size"], sparse=sparse)
+        self.y_shape_embeddings_t = nn.Embedding(6 * max_2d_positions, config["shape_size"], sparse=sparse)
 
         self.LayerNorm = nn.LayerNorm(config["hidden_size"], eps=config["layer_norm_eps"])
         self.dropout = nn.Dropout(config["hidden_dropout_prob"])
 
-        self.x_embedding_v = [
-            self.x_topleft_position_embeddings_v,
-            self.x_bottomright_position_embeddings_v,
-            self.w_position_embeddings_v,
-            self.x_topleft_distance_to_prev_embeddings_v,
-            self.x_bottomleft_distance_to_prev_embeddings_v,
-            self.x_topright_distance_to_prev_embeddings_v,
-            self.x_bottomright_distance_to_prev_embeddings_v,
-            self.x_centroid_distance_to_prev_embeddings_v,
-        ]
-
-        self.y_embedding_v = [
-            self.y_topleft_position_embeddings_v,
-            self.y_bottomright_position_embeddings_v,
-            self.h_position_embeddings_v,
-            self.y_topleft_distance_to_prev_embeddings_v,
-            self.y_bottomleft_distance_to_prev_embeddings_v,
-            self.y_topright_distance_to_prev_embeddings_v,
-            self.y_bottomright_distance_to_prev_embeddings_v,
-            self.y_centroid_distance_to_prev_embeddings_v,
-        ]
-
-        self.x_embedding_t = [
-            self.x_topleft_position_embeddings_t,
-            self.x_bottomright_position_embeddings_t,
-            self.w_position_embeddings_t,
-            self.x_topleft_distance_to_prev_embeddings_t,
-            self.x_bottomleft_distance_to_prev_embeddings_t,
-            self.x_topright_distance_to_prev_embeddings_t,
-            self.x_bottomright_distance_to_prev_embeddings_t,
-            self.x_centroid_distance_to_prev_embeddings_t,
-        ]
-
-        self.y_embedding_t = [
-            self.y_topleft_position_embeddings_t,
-            self.y_bottomright_position_embeddings_t,
-            self.h_position_embeddings_t,
-            self.y_topleft_distance_to_prev_embeddings_t,
-            self.y_bottomleft_distance_to_prev_embeddings_t,
-            self.y_topright_distance_to_prev_embeddings_t,
-            self.y_bottomright_distance_to_prev_embeddings_t,
-            self.y_centroid_distance_to_prev_embeddings_t,
-        ]
+        # row offset of every feature inside its table
+        self.register_buffer("position_offsets", torch.arange(2) * max_2d_positions, persistent=False)
+        self.register_buffer("shape_offsets", torch.arange(6) * max_2d_positions, persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the shared tables store one table per feature, stack them (in feature
+        # order, see `forward`) into the shared position / shape tables and drop the unused `x_v` table
+        for axis, size in (("x", "w"), ("y", "h")):
+            for modality in ("v", "t"):
+                position_tables = [f"{axis}_topleft_position_embeddings_{modality}",
+                                   f"{axis}_bottomright_position_embeddings_{modality}"]
+                shape_tables = [f"{size}_position_embeddings_{modality}"] + [
+                    f"{axis}_{corner}_distance_to_prev_embeddings_{modality}"
+                    for corner in ("topleft", "bottomleft", "topright", "bottomright", "centroid")
+                ]
+                for shared, tables in ((f"{axis}_position_embeddings_{modality}", position_tables),
+                                       (f"{axis}_shape_embeddings_{modality}", shape_tables)):
+                    keys = [f"{prefix}{table}.weight" for table in tables]
+                    if all(key in state_dict for key in keys):
+                        state_dict[f"{prefix}{shared}.weight"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        state_dict.pop(f"{prefix}x_v.weight", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _embed(self, feature, position_embeddings, shape_embeddings):
+        batch, seq_len = feature.shape[:-1]
+        position = position_embeddings(feature[..., :2] + self.position_offsets)
+        shape = shape_embeddings(feature[..., 2:] + self.shape_offsets)
+        return torch.cat([position.reshape(batch, seq_len, -1), shape.reshape(batch, seq_len, -1)], dim=-1)
 
     def forward(self, x_feature, y_feature):
 
@@ -186,36 +151,19 @@ class DocFormerEmbeddings(nn.Module):
         6 -> diff bottom right x/y
         7 -> centroids diff x/y
         """
-        batch, seq_len = x_feature.shape[:-1]
-        hidden_size = self.config["hidden_size"]
-        num_feat = x_feature.shape[-1]
-        sub_dim = hidden_size // num_feat
-
-        x_calculated_embedding_v = torch.zeros(batch, seq_len, hidden_size)
-        y_calculated_embedding_v = torch.zeros(batch, seq_len, hidden_size)
-        x_calculated_embedding_v.to(x_feature.device)
-        y_calculated_embedding_v.to(x_feature.device)
-
-        for i in range(num_feat):
-            temp_x = x_feature[:, :, i]  # shape (batch_size, seq_len)
-            x_calculated_embedding_v[..., i * sub_dim: (i + 1) * sub_dim] = self.x_embedding_v[i](temp_x)
-            temp_y = y_feature[:, :, i]
-            y_calculated_embedding_v[..., i * sub_dim: (i + 1) * sub_dim] = self.y_embedding_v[i](temp_y)
+        # the tables are shared between features, so an out of range index would silently read another
+        # feature's rows; checked once per input and without a device sync (create_features checks on CPU)
+        for feature in (x_feature, y_feature):
+            low, high = torch.aminmax(feature)
+            torch._assert_async((low >= 0) & (high < self.max_2d_positions))
 
-        v_bar_s = x_calculated_embedding_v + y_calculated_embedding_v + self.position_embeddings_v()
+        x_calculated_embedding_v = self._embed(x_feature, self.x_position_embeddings_v, self.x_shape_embeddings_v)
+        y_calculated_embedding_v = self._embed(y_feature, self.y_position_embeddings_v, self.y_shape_embeddings_v)
+        v_bar_s = self.position_embeddings_v(x_calculated_embedding_v + y_calculated_embedding_v)
 
-        x_calculated_embedding_t = torch.zeros(batch, seq_len, hidden_size)
-        y_calculated_embedding_t = torch.zeros(batch, seq_len, hidden_size)
-        x_calculated_embedding_t.to(x_feature.device)
-        y_calculated_embedding_t.to(x_feature.device)
-
-        for i in range(num_feat):
-            temp_x = x_feature[:, :, i]  # shape (batch_size, seq_len)
-            x_calculated_embedding_t[..., i * sub_dim: (i + 1) * sub_dim] = self.x_embedding_t[i](temp_x)
-            temp_y = y_feature[:, :, i]
-            y_calculated_embedding_t[..., i * sub_dim: (i + 1) * sub_dim] = self.y_embedding_t[i](temp_y)
-
-        t_bar_s = x_calculated_embedding_t + y_calculated_embedding_t + self.position_embeddings_t()
+        x_calculated_embedding_t = self._embed(x_feature, self.x_position_embeddings_t, self.x_shape_embeddings_t)
+        y_calculated_embedding_t = self._embed(y_feature, self.y_position_embeddings_t, self.y_shape_embeddings_t)
+        t_bar_s = self.position_embeddings_t(x_calculated_embedding_t + y_calculated_embedding_t)
 
         return v_bar_s, t_bar_s
 
@@ -273,12 +221,12 @@ class RelativePosition(nn.Module):
         self.max_relative_position = max_relative_position
         self.embeddings_table = nn.Parameter(torch.Tensor(max_relative_position * 2 + 1, num_units))
         self.max_length = max_seq_length
-        range_vec_q = torch.arange(max_seq_length)
-        range_vec_k = torch.arange(max_seq_length)
-        distance_mat = range_vec_k[None, :] - range_vec_q[:, None]
-        distance_mat_clipped = torch.clamp(distance_mat, -self.max_relative_position, self.max_relative_position)
+        range_vec = np.arange(max_seq_length)
+        distance_mat = range_vec[None, :] - range_vec[:, None]
+        distance_mat_clipped = np.clip(distance_mat, -self.max_relative_position, self.max_relative_position)
         final_mat = distance_mat_clipped + self.max_relative_position
-        self.final_mat = torch.LongTensor(final_mat)
+        # a buffer (rather than a plain attribute) follows the module to its device
+        self.register_buffer("final_mat", torch.from_numpy(final_mat).long(), persistent=False)
         nn.init.xavier_uniform_(self.embeddings_table)
 
     def forward(self, length_q, length_k):
@@ -298,19 +246,14 @@ class MultiModalAttentionLayer(nn.Module):
         self.relative_positions_text = RelativePosition(self.head_dim, max_relative_position, max_seq_length)
         self.relative_positions_img = RelativePosition(self.head_dim, max_relative_position, max_seq_length)
 
-        # text qkv embeddings
-        self.fc_k_text = nn.Linear(embed_dim, embed_dim)
-        self.fc_q_text = nn.Linear(embed_dim, embed_dim)
-        self.fc_v_text = nn.Linear(embed_dim, embed_dim)
+        # text qkv embeddings (fused into a single projection)
+        self.qkv_text = nn.Linear(embed_dim, 3 * embed_dim)
 
-        # image qkv embeddings
-        self.fc_k_img = nn.Linear(embed_dim, embed_dim)
-        self.fc_q_img = nn.Linear(embed_dim, embed_dim)
-        self.fc_v_img = nn.Linear(embed_dim, embed_dim)
+        # image qkv embeddings (fused into a single projection)
+        self.qkv_img = nn.Linear(embed_dim, 3 * embed_dim)
 
         # spatial qk embeddings (shared for visual and text)
-        self.fc_k_spatial = nn.Linear(embed_dim, embed_dim)
-        self.fc_q_spatial = nn.Linear(embed_dim, embed_dim)
+        self.qk_spatial = nn.Linear(embed_dim, 2 * embed_dim)
 
         self.dropout = nn.Dropout(dropout)
 
@@ -318,7 +261,27 @@ class MultiModalAttentionLayer(nn.Module):
             nn.Linear(embed_dim, embed_dim),
             nn.Dropout(dropout)
         )
-        self.scale = torch.sqrt(torch.FloatTensor([embed_dim]))
+        self.inv_scale = 1.0 / math.sqrt(embed_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fused projections store separate fc_{q,k,v}_{text,img} and
+        # fc_{q,k}_spatial layers, concatenate them (in q, k, v order) into the fused ones
+        fused_layers = {
+            'qkv_text': ('fc_q_text', 'fc_k_text', 'fc_v_text'),
+            'qkv_img': ('fc_q_img', 'fc_k_img', 'fc_v_img'),
+            'qk_spatial': ('fc_q_spatial', 'fc_k_spatial'),
+        }
+        for fused, layers in fused_layers.items():
+            for param in ('weight', 'bias'):
+                keys = [f'{prefix}{layer}.{param}' for layer in layers]
+                if all(key in state_dict for key in keys):
+                    state_dict[f'{prefix}{fused}.{param}'] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _split_heads(self, x):
+        # b -> batch, l -> length, head -> # of heads, k -> head dim: (b, l, head * k) -> (b, head, l, k)
+        batch, seq_length = x.shape[:2]
+        return x.view(batch, seq_length, self.n_heads, self.head_dim).transpose(1, 2)
 
     def forward(self, text_feat, img_feat, text_spatial_feat, img_spatial_feat):
         text_feat = text_feat
@@ -327,12 +290,16 @@ class MultiModalAttentionLayer(nn.Module):
         img_spatial_feat = img_spatial_feat
         seq_length = text_feat.shape[1]
 
+        # shared spatial qk projection, a single GEMM over the text and image spatial features
+        qk_spatial = self.qk_spatial(torch.cat([text_spatial_feat, img_spatial_feat], dim=0))
+        qk_spatial_text, qk_spatial_img = qk_spatial.chunk(2, dim=0)
+
         # self attention of text
         # b -> batch, t -> time steps (l -> length has same meaning), head -> # of heads, k -> head dim.
-        key_text_nh = rearrange(self.fc_k_text(text_feat), 'b t (head k) -> head b t k', head=self.n_heads).to(DEVICE)
-        query_text_nh = rearrange(self.fc_q_text(text_feat), 'b l (head k) -> head b l k', head=self.n_heads).to(DEVICE)
-        value_text_nh = rearrange(self.fc_v_text(text_feat), 'b t (head k) -> head b t k', head=self.n_heads).to(DEVICE)
-        dots_text = torch.einsum('hblk,hbtk->hblt', query_text_nh, key_text_nh) / self.scale.to(DEVICE)
+        query_text, key_text, value_text = self.qkv_text(text_feat).chunk(3, dim=-1)
+        key_text_nh = self._split_heads(key_text)
+        query_text_nh = self._split_heads(query_text)
+        value_text_nh = self._split_heads(value_text)
 
         # 1D relative positions (query, key)
         rel_pos_embed_text = self.relative_positions_text(seq_length, seq_length)
@@ -340,45 +307,53 @@ class MultiModalAttentionLayer(nn.Module):
         rel_pos_query_text = torch.einsum('bhld,lrd->bhlr', query_text_nh, rel_pos_embed_text)
 
         # shared spatial <-> text hidden features
-        key_spatial_text = self.fc_k_spatial(text_spatial_feat)
-        query_spatial_text = self.fc_q_spatial(text_spatial_feat)
-        key_spatial_text_nh = rearrange(key_spatial_text, 'b t (head k) -> head b t k', head=self.n_heads)
-        query_spatial_text_nh = rearrange(query_spatial_text, 'b l (head k) -> head b l k', head=self.n_heads)
-        dots_text_spatial = torch.einsum('hblk,hbtk->hblt', query_spatial_text_nh, key_spatial_text_nh) / self.scale.to(DEVICE)
-
-        # Line 38 of pseudo-code
-        text_attn_scores = dots_text + rel_pos_key_text + rel_pos_query_text + dots_text_spatial
+        query_spatial_text, key_spatial_text = qk_spatial_text.chunk(2, dim=-1)
+        key_spatial_text_nh = self._split_heads(key_spatial_text)
+        query_spatial_text_nh = self._split_heads(query_spatial_text)
+
+        # Line 38 of pseudo-code, the q.k^T term is added inside scaled_dot_product_attention
+        # the scaled spatial dot product and the relative position terms in one batched GEMM
+        rel_pos_text = rel_pos_key_text + rel_pos_query_text
+        text_attn_bias = torch.baddbmm(rel_pos_text.flatten(0, 1),
+                                       query_spatial_text_nh.flatten(0, 1),
+                                       key_spatial_text_nh.flatten(0, 1).transpose(1, 2),
+                                       alpha=self.inv_scale).view_as(rel_pos_text)
 
         # self-attention of image
-        key_img_nh = rearrange(self.fc_k_img(img_feat), 'b t (head k) -> head b t k', head=self.n_heads).to(DEVICE)
-        query_img_nh = rearrange(self.fc_q_img(img_feat), 'b l (head k) -> head b l k', head=self.n_heads).to(DEVICE)
-        value_img_nh = rearrange(self.fc_v_img(img_feat), 'b t (head k) -> head b t k', head=self.n_heads).to(DEVICE)
-        dots_img = torch.einsum('hblk,hbtk->hblt', query_img_nh, key_img_nh) / self.scale.to(DEVICE)
+        query_img, key_img, value_img = self.qkv_img(img_feat).chunk(3, dim=-1)
+        key_img_nh = self._split_heads(key_img)
+        query_img_nh = self._split_heads(query_img)
+        value_img_nh = self._split_heads(value_img)
 
         # 1D relative positions (query, key)
         rel_pos_embed_img = self.relative_positions_img(seq_length, seq_length)
-        rel_pos_key_img = torch.einsum('bhrd,lrd->bhlr', key_img_nh, rel_pos_embed_text)
-        rel_pos_query_img = torch.einsum('bhld,lrd->bhlr', query_img_nh, rel_pos_embed_text)
+        rel_pos_key_img = torch.einsum('bhrd,lrd->bhlr', key_img_nh, rel_pos_embed_img)
+        rel_pos_query_img = torch.einsum('bhld,lrd->bhlr', query_img_nh, rel_pos_embed_img)
 
         # shared spatial <-> image features
-        key_spatial_img = self.fc_k_spatial(img_spatial_feat)
-        query_spatial_img = self.fc_q_spatial(img_spatial_feat)
-        key_spatial_img_nh = rearrange(key_spatial_img, 'b t (head k) -> head b t k', head=self.n_heads)
-        query_spatial_img_nh = rearrange(query_spatial_img, 'b l (head k) -> head b l k', head=self.n_heads)
-        dots_img_spatial = torch.einsum('hblk,hbtk->hblt', query_spatial_img_nh, key_spatial_img_nh) / self.scale.to(DEVICE)
+        query_spatial_img, key_spatial_img = qk_spatial_img.chunk(2, dim=-1)
+        key_spatial_img_nh = self._split_heads(key_spatial_img)
+        query_spatial_img_nh = self._split_heads(query_spatial_img)
 
         # Line 59 of pseudo-code
-        img_attn_scores = dots_img + rel_pos_key_img + rel_pos_query_img + dots_img_spatial
-
-        text_attn_probs = self.dropout(torch.softmax(text_attn_scores, dim=-1))
-        img_attn_probs = self.dropout(torch.softmax(img_attn_scores, dim=-1))
-
-        text_context = torch.einsum('hblt,hbtv->hblv', text_attn_probs, value_text_nh)
-        img_context = torch.einsum('hblt,hbtv->hblv', img_attn_probs, value_img_nh)
+        # the scaled spatial dot product and the relative position terms in one batched GEMM
+        rel_pos_img = rel_pos_key_img + rel_pos_query_img
+        img_attn_bias = torch.baddbmm(rel_pos_img.flatten(0, 1),
+                                      query_spatial_img_nh.flatten(0, 1),
+                                      key_spatial_img_nh.flatten(0, 1).transpose(1, 2),
+                                      alpha=self.inv_scale).view_as(rel_pos_img)
+
+        dropout_p = self.dropout.p if self.training else 0.0
+        text_context = F.scaled_dot_product_attention(query_text_nh, key_text_nh, value_text_nh,
+                                                      attn_mask=text_attn_bias, dropout_p=dropout_p,
+                                                      scale=self.inv_scale)
+        img_context = F.scaled_dot_product_attention(query_img_nh, key_img_nh, value_img_nh,
+                                                     attn_mask=img_attn_bias, dropout_p=dropout_p,
+                                                     scale=self.inv_scale)
 
         context = text_context + img_context
 
-        embeddings = rearrange(context, 'head b t d -> b t (head d)')
+        embeddings = context.transpose(1, 2).reshape(text_feat.shape)
         return self.to_out(embeddings)
 
 
@@ -403,6 +378,25 @@ class DocFormerEncoder(nn.Module):
                                     dropout=config['hidden_dropout_prob']))
             ])
             self.layers.append(encoder_block)
+        self._compile_args = None
+
+    def compile(self, *args, **kwargs):
+        # remembered so that copies and unpickled encoders can be compiled again, see `__setstate__`
+        self._compile_args = (args, kwargs)
+        super().compile(*args, **kwargs)
+
+    def __getstate__(self):
+        # the compiled callable closes over this very instance: a deep copy would keep running the
+        # original's layers (e.g. in quantize_encoder) and pickling would fail, so it is never copied
+        state = self.__dict__.copy()
+        state['_compiled_call_impl'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self._compile_args is not None:
+            args, kwargs = self._compile_args
+            super().compile(*args, **kwargs)
 
     def forward(
             self,
@@ -413,12 +407,21 @@ class DocFormerEncoder(nn.Module):
     ):
         # Fig 1 encoder part (skip conn for both attn & FF): https://arxiv.org/abs/1706.03762
         # TODO: ensure 1st skip conn (var "skip") in such a multimodal setting makes sense (most likely does)
-        for attn, ff in self.layers:
-            skip = text_feat + img_feat + text_spatial_feat + img_spatial_feat
-            x = attn(text_feat, img_feat, text_spatial_feat, img_spatial_feat) + skip
-            x = ff(x) + x
-            text_feat = x
-        return x
+        # the matmuls run in bf16 if enabled, autocast keeps layernorm and softmax in fp32.
+        # When disabled, no autocast context is entered so that an outer one (AMP training) stays active.
+        bf16 = self.config.get('bf16', False)
+        dtype = text_feat.dtype
+        autocast = (torch.autocast(device_type=text_feat.device.type, dtype=torch.bfloat16) if bf16
+                    else contextlib.nullcontext())
+        with autocast:
+            # only text_feat changes between blocks, the rest of the skip connection is loop invariant
+            const_skip = img_feat + text_spatial_feat + img_spatial_feat
+            for attn, ff in self.layers:
+                skip = text_feat + const_skip
+                x = attn(text_feat, img_feat, text_spatial_feat, img_spatial_feat) + skip
+                x = ff(x) + x
+                text_feat = x
+        return x.to(dtype) if bf16 else x
 
 
 class LanguageFeatureExtractor(nn.Module):
@@ -468,21 +471,32 @@ class ExtractFeatures(nn.Module):
         return v_bar, t_bar, v_bar_s, t_bar_s
 
 
+def compile_encoder(encoder, config):
+
+    '''
+    If `config['compile']` is set, compiles the encoder in place with `nn.Module.compile`. The module itself is
+    not wrapped, so the state dict keys stay the same as for an eager encoder, and copies (deepcopy, pickle)
+    are compiled again on their own parameters. The default mode is used (no CUDA graphs), so the returned
+    outputs are not reused by a subsequent call.
+    '''
+
+    if config.get('compile', False):
+        encoder.compile()
+    return encoder
+
+
 class DocFormerForClassification(nn.Module):
     def __init__(self, config, num_classes):
         super().__init__()
         self.config = config
         self.extract_feature = ExtractFeatures(config)
-        self.encoder = DocFormerEncoder(config)
+        self.encoder = compile_encoder(DocFormerEncoder(config), config)
         self.dropout = nn.Dropout(config['hidden_dropout_prob'])
         self.classifier = nn.Linear(config['hidden_size'], num_classes)
 
     def forward(self, x ,use_tdi = False):
         v_bar, t_bar, v_bar_s, t_bar_s = self.extract_feature(x,use_tdi)
-        features = {'v_bar': v_bar, 't_bar': t_bar, 'v_bar_s': v_bar_s, 't_bar_s': t_bar_s}
-        for f in features:
-            features[f] = features[f]
-        output = self.encoder(features['t_bar'], features['v_bar'], features['t_bar_s'], features['v_bar_s'])
+        output = self.encoder(t_bar, v_bar, t_bar_s, v_bar_s)
         output = self.dropout(output)
         output = self.classifier(output)
         return output
@@ -497,15 +511,12 @@ class DocFormer(nn.Module):
         super().__init__()
         self.config = config
         self.extract_feature = ExtractFeatures(config)
-        self.encoder = DocFormerEncoder(config)
+        self.encoder = compile_encoder(DocFormerEncoder(config), config)
         self.dropout = nn.Dropout(config['hidden_dropout_prob'])
 
     def forward(self, x ,use_tdi=False):
         v_bar, t_bar, v_bar_s, t_bar_s = self.extract_feature(x,use_tdi)
-        features = {'v_bar': v_bar, 't_bar': t_bar, 'v_bar_s': v_bar_s, 't_bar_s': t_bar_s}
-        for f in features:
-            features[f] = features[f]
-        output = self.encoder(features['t_bar'], features['v_bar'], features['t_bar_s'], features['v_bar_s'])
+        output = self.encoder(t_bar, v_bar, t_bar_s, v_bar_s)
         output = self.dropout(output)
         return output
 
@@ -524,32 +535,56 @@ class ShallowDecoder(nn.Module):
 
         # decoder 
         self.linear1 = nn.Linear(in_features = 768,out_features = 512)                        # Making the image to be symmetric
-        self.conv1 = nn.Conv2d(in_channels = 1, out_channels = 3,kernel_size = 3,stride = 1)
-        self.conv2 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 3,stride = 1)
+        self.bn0 = nn.BatchNorm2d(num_features = 1)
+        self.relu = nn.ReLU(inplace = True)
+
+        # conv -> batch norm -> relu blocks, kept as a flat sequence so that `fuse_model` can fold them
+        self.decoder_seq = nn.Sequential(
+            nn.Conv2d(in_channels = 1, out_channels = 3,kernel_size = 3,stride = 1), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 3,stride = 1), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
+
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 5,stride = 1), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 5,stride = 2), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
 
-        self.conv3 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 5,stride = 1)
-        self.conv4 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 5,stride = 2)
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
 
-        self.conv5 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7)
-        self.conv6 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7)
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
 
-        self.conv7 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7)
-        self.conv8 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 7)
+            nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 3,stride = 1), nn.BatchNorm2d(3), nn.ReLU(inplace = True),
+        )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before `decoder_seq` store the convs as conv1..conv9 and hold no batch norm state
+        # (the norms were rebuilt on every forward), so those norms keep their initial values
+        legacy_keys = [key for key in state_dict if key.startswith(f"{prefix}conv")]
+        if legacy_keys:
+            for key in legacy_keys:
+                index, param = key[len(f"{prefix}conv"):].split(".", 1)
+                state_dict[f"{prefix}decoder_seq.{3 * (int(index) - 1)}.{param}"] = state_dict.pop(key)
+            for name, module in self.named_modules():
+                if isinstance(module, nn.BatchNorm2d):
+                    for key, value in module.state_dict().items():
+                        state_dict.setdefault(f"{prefix}{name}.{key}", value)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def fuse_model(self):
 
-        self.conv9 = nn.Conv2d(in_channels = 3, out_channels = 3,kernel_size = 3,stride = 1)
+        '''
+        Folds every conv + batch norm + relu block of the decoder into a single fused conv. Only meant for
+        inference, so the decoder is switched to eval mode (batch norm running stats are folded in).
+        '''
+
+        self.eval()
+        blocks = [[str(i), str(i + 1), str(i + 2)] for i in range(0, len(self.decoder_seq), 3)]
+        torch.ao.quantization.fuse_modules(self.decoder_seq, blocks, inplace=True)
+        return self
 
     def forward(self, x):
-          x = x.unsqueeze(1).cuda()
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=1).cuda()(self.linear1(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv1(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv2(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv3(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv4(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv5(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv6(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv7(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv8(x)))
-          x = nn.ReLU()(torch.nn.BatchNorm2d(num_features=3).cuda()(self.conv9(x)))
+          x = x.unsqueeze(1)
+          x = self.relu(self.bn0(self.linear1(x)))
+          x = self.decoder_seq(x)
           return torch.sigmoid(x)
 
 
@@ -558,18 +593,29 @@ class DocFormer_For_IR(nn.Module):
         super().__init__()
         self.config = config
         self.extract_feature = ExtractFeatures(config)
-        self.encoder = DocFormerEncoder(config)
+        self.encoder = compile_encoder(DocFormerEncoder(config), config)
         self.dropout = nn.Dropout(config['hidden_dropout_prob'])
         self.classifier = nn.Linear(in_features=68, out_features=num_classes)
-        self.decoder = ShallowDecoder().cuda()
+        self.decoder = ShallowDecoder()
 
     def forward(self, x,use_tdi=False):
         v_bar, t_bar, v_bar_s, t_bar_s = self.extract_feature(x,use_tdi)
-        features = {'v_bar': v_bar, 't_bar': t_bar, 'v_bar_s': v_bar_s, 't_bar_s': t_bar_s}
-        for f in features:
-            features[f] = features[f]
-        output = self.encoder(features['t_bar'], features['v_bar'], features['t_bar_s'], features['v_bar_s'])
+        output = self.encoder(t_bar, v_bar, t_bar_s, v_bar_s)
         output = self.dropout(output)
         output_mlm = self.classifier(output)
         output_ir = self.decoder(output) 
         return {'mlm_labels':output_mlm,'ir':output_ir}
+
+
+def quantize_encoder(model):
+
+    '''
+    Post-training dynamic INT8 quantization of the Linear layers of `model.encoder` (the q/k/v projections
+    and the feed forward layers), for CPU inference. The attention output projections (`to_out`) feeding the
+    residual sums are kept in floating point, as are the layernorms and embeddings.
+    '''
+
+    linear_layers = {name for name, module in model.encoder.named_modules()
+                     if isinstance(module, nn.Linear) and 'to_out' not in name.split('.')}
+    model.encoder = torch.ao.quantization.quantize_dynamic(model.encoder, linear_layers, dtype=torch.qint8)
+    return model
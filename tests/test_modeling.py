@@ -0,0 +1,295 @@
+import copy
+import io
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from docformer.modeling import (  # noqa: E402
+    DocFormerEmbeddings,
+    DocFormerEncoder,
+    MultiModalAttentionLayer,
+    ShallowDecoder,
+    quantize_encoder,
+)
+
+CONFIG = {
+    "coordinate_size": 2,
+    "hidden_dropout_prob": 0.0,
+    "hidden_size": 16,
+    "intermediate_ff_size_factor": 2,
+    "layer_norm_eps": 1e-12,
+    "max_2d_position_embeddings": 10,
+    "max_position_embeddings": 4,
+    "max_relative_positions": 2,
+    "num_attention_heads": 2,
+    "num_hidden_layers": 2,
+    "pad_token_id": 0,
+    "shape_size": 2,
+    "vocab_size": 10,
+}
+
+
+def make_attention_layer():
+    return MultiModalAttentionLayer(
+        embed_dim=16, n_heads=2, max_relative_position=2, max_seq_length=4, dropout=0.0
+    )
+
+
+def test_embeddings_reject_out_of_range_features():
+    embeddings = DocFormerEmbeddings(CONFIG)
+    features = torch.zeros(1, 4, 8, dtype=torch.long)
+    features[0, 0, 0] = CONFIG["max_2d_position_embeddings"]
+
+    with pytest.raises(RuntimeError):
+        embeddings(features, torch.zeros_like(features))
+
+
+def test_embeddings_load_per_feature_checkpoints():
+    embeddings = DocFormerEmbeddings(CONFIG)
+    state_dict = {
+        k: v
+        for k, v in embeddings.state_dict().items()
+        if "_position_embeddings_" not in k and "_shape_embeddings_" not in k
+    }
+    features = [
+        "topleft_position",
+        "bottomright_position",
+        "size_position",
+        "topleft_distance_to_prev",
+        "bottomleft_distance_to_prev",
+        "topright_distance_to_prev",
+        "bottomright_distance_to_prev",
+        "centroid_distance_to_prev",
+    ]
+    legacy = {}
+    for axis, size in [("x", "w"), ("y", "h")]:
+        for modality in ["v", "t"]:
+            for feature in features:
+                if feature == "size_position":
+                    name = f"{size}_position"
+                else:
+                    name = f"{axis}_{feature}"
+                legacy[f"{name}_embeddings_{modality}.weight"] = torch.randn(10, 2)
+    state_dict.update(legacy)
+    state_dict["x_v.weight"] = torch.randn(10, 2)
+
+    embeddings.load_state_dict(state_dict)
+
+    assert torch.equal(
+        embeddings.x_position_embeddings_v.weight[10:],
+        legacy["x_bottomright_position_embeddings_v.weight"],
+    )
+    assert torch.equal(
+        embeddings.y_shape_embeddings_t.weight[:10],
+        legacy["h_position_embeddings_t.weight"],
+    )
+    assert torch.equal(
+        embeddings.y_shape_embeddings_t.weight[50:],
+        legacy["y_centroid_distance_to_prev_embeddings_t.weight"],
+    )
+
+
+def test_img_branch_uses_img_relative_positions():
+    torch.manual_seed(0)
+    layer = make_attention_layer().eval()
+    feats = torch.randn(4, 2, 4, 16).unbind(0)
+
+    with torch.no_grad():
+        before = layer(*feats)
+        layer.relative_positions_img.embeddings_table.add_(1.0)
+        after = layer(*feats)
+
+    assert not torch.allclose(before, after)
+
+
+def test_attention_loads_unfused_projection_checkpoints():
+    layer = make_attention_layer()
+    state_dict = {
+        k: v
+        for k, v in layer.state_dict().items()
+        if not k.startswith(("qkv_", "qk_"))
+    }
+    names = ["text", "img", "spatial"]
+    legacy = {}
+    for name in names:
+        for projection in ["q", "k", "v"]:
+            if name == "spatial" and projection == "v":
+                continue
+            legacy[f"fc_{projection}_{name}.weight"] = torch.randn(16, 16)
+            legacy[f"fc_{projection}_{name}.bias"] = torch.randn(16)
+    state_dict.update(legacy)
+
+    layer.load_state_dict(state_dict)
+
+    fused_layers = {
+        "qkv_text": ["fc_q_text", "fc_k_text", "fc_v_text"],
+        "qkv_img": ["fc_q_img", "fc_k_img", "fc_v_img"],
+        "qk_spatial": ["fc_q_spatial", "fc_k_spatial"],
+    }
+    for fused, layers in fused_layers.items():
+        for param in ["weight", "bias"]:
+            expected = torch.cat([legacy[f"{name}.{param}"] for name in layers])
+            assert torch.equal(getattr(layer, fused).state_dict()[param], expected)
+
+
+def test_compiled_encoder_copies_run_their_own_layers():
+    torch.manual_seed(0)
+    encoder = DocFormerEncoder(CONFIG).eval()
+    encoder.compile(backend="eager")
+    copied = copy.deepcopy(encoder)
+    feats = torch.randn(4, 2, 4, 16).unbind(0)
+
+    with torch.no_grad():
+        expected = encoder(*feats)
+        copied.layers[0][1].fn.net[0].bias.add_(1.0)
+        assert torch.allclose(encoder(*feats), expected)
+        assert not torch.allclose(copied(*feats), expected)
+
+    assert copied._compiled_call_impl is not None
+    torch.save(copied, io.BytesIO())
+
+
+def reference_attention(layer, text_feat, img_feat, text_spatial, img_spatial):
+    # the pre-SDPA formulation in the (head, batch, length, head dim) layout:
+    # softmax(q.k / sqrt(embed_dim) + rel_k + rel_q + spatial) @ v, summed over
+    # both modalities
+    batch, seq_length, embed_dim = text_feat.shape
+    scale = embed_dim**0.5
+
+    def heads(x):
+        return x.view(batch, seq_length, layer.n_heads, -1).permute(2, 0, 1, 3)
+
+    context = 0
+    for feat, spatial, qkv, relative_positions in [
+        (text_feat, text_spatial, layer.qkv_text, layer.relative_positions_text),
+        (img_feat, img_spatial, layer.qkv_img, layer.relative_positions_img),
+    ]:
+        query, key, value = map(heads, qkv(feat).chunk(3, dim=-1))
+        query_spatial, key_spatial = map(heads, layer.qk_spatial(spatial).chunk(2, -1))
+        rel_pos_embed = relative_positions(seq_length, seq_length)
+
+        dots = torch.einsum("hblk,hbtk->hblt", query, key) / scale
+        rel_pos_key = torch.einsum("hbrd,lrd->hblr", key, rel_pos_embed)
+        rel_pos_query = torch.einsum("hbld,lrd->hblr", query, rel_pos_embed)
+        dots_spatial = (
+            torch.einsum("hblk,hbtk->hblt", query_spatial, key_spatial) / scale
+        )
+        scores = dots + rel_pos_key + rel_pos_query + dots_spatial
+        context = context + torch.einsum(
+            "hblt,hbtv->hblv", torch.softmax(scores, dim=-1), value
+        )
+
+    context = context.permute(1, 2, 0, 3).reshape(batch, seq_length, embed_dim)
+    return layer.to_out(context)
+
+
+def test_attention_matches_einsum_reference():
+    torch.manual_seed(0)
+    layer = make_attention_layer().eval()
+    feats = torch.randn(4, 2, 4, 16).unbind(0)
+
+    with torch.no_grad():
+        expected = reference_attention(layer, *feats)
+        actual = layer(*feats)
+
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+def test_shallow_decoder_loads_conv_checkpoints_and_fuses():
+    torch.manual_seed(0)
+    decoder = ShallowDecoder()
+    legacy = {
+        "linear1.weight": torch.randn_like(decoder.linear1.weight),
+        "linear1.bias": torch.randn_like(decoder.linear1.bias),
+    }
+    for i in range(1, 10):
+        conv = decoder.decoder_seq[3 * (i - 1)]
+        legacy[f"conv{i}.weight"] = torch.randn_like(conv.weight)
+        legacy[f"conv{i}.bias"] = torch.randn_like(conv.bias)
+
+    # baseline checkpoints hold no batch norm state, a strict load must still work
+    decoder.load_state_dict(legacy)
+
+    assert torch.equal(decoder.decoder_seq[3].weight, legacy["conv2.weight"])
+    assert torch.equal(decoder.decoder_seq[24].bias, legacy["conv9.bias"])
+
+    with torch.no_grad():
+        for bn in decoder.decoder_seq[1::3]:
+            bn.weight.uniform_(0.5, 1.5)
+            bn.bias.uniform_(-0.5, 0.5)
+            bn.running_mean.uniform_(-0.5, 0.5)
+            bn.running_var.uniform_(0.5, 1.5)
+    decoder.eval()
+    x = torch.randn(2, 80, 768)
+
+    with torch.no_grad():
+        expected = decoder(x)
+        decoder.fuse_model()
+        actual = decoder(x)
+
+    assert not isinstance(decoder.decoder_seq[1], torch.nn.BatchNorm2d)
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("compile_encoder", [False, True])
+def test_quantize_encoder(compile_encoder):
+    torch.manual_seed(0)
+    encoder = DocFormerEncoder(CONFIG).eval()
+    if compile_encoder:
+        encoder.compile(backend="eager")
+    feats = torch.randn(4, 2, 4, 16).unbind(0)
+    with torch.no_grad():
+        expected = encoder(*feats)
+
+    model = quantize_encoder(types.SimpleNamespace(encoder=encoder))
+
+    dynamic_linear = torch.ao.nn.quantized.dynamic.Linear
+    for attn, ff in model.encoder.layers:
+        for name in ["qkv_text", "qkv_img", "qk_spatial"]:
+            assert isinstance(getattr(attn.fn, name), dynamic_linear)
+        assert isinstance(ff.fn.net[0], dynamic_linear)
+        assert isinstance(ff.fn.net[3], dynamic_linear)
+        assert type(attn.fn.to_out[0]) is torch.nn.Linear
+
+    with torch.no_grad():
+        actual = model.encoder(*feats)
+
+    # the quantized layers really run (not the float ones) and stay close to them
+    assert not torch.equal(actual, expected)
+    assert (actual - expected).norm() / expected.norm() < 0.05
+
+
+def run_encoder_recording_matmul_dtype(encoder, feats):
+    dtypes = []
+    ff_linear = encoder.layers[0][1].fn.net[0]
+    handle = ff_linear.register_forward_hook(lambda m, i, out: dtypes.append(out.dtype))
+    with torch.no_grad():
+        output = encoder(*feats)
+    handle.remove()
+    return output, dtypes[0]
+
+
+def test_encoder_bf16_returns_input_dtype():
+    encoder = DocFormerEncoder({**CONFIG, "bf16": True}).eval()
+    feats = torch.randn(4, 2, 4, 16).unbind(0)
+
+    output, matmul_dtype = run_encoder_recording_matmul_dtype(encoder, feats)
+    assert matmul_dtype == torch.bfloat16
+    assert output.dtype == torch.float32
+
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        output, _ = run_encoder_recording_matmul_dtype(encoder, feats)
+    assert output.dtype == torch.float32
+
+
+def test_encoder_keeps_outer_autocast_active():
+    encoder = DocFormerEncoder(CONFIG).eval()
+    feats = torch.randn(4, 2, 4, 16).unbind(0)
+
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        _, matmul_dtype = run_encoder_recording_matmul_dtype(encoder, feats)
+
+    assert matmul_dtype == torch.bfloat16